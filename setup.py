@@ -14,9 +14,14 @@ setup(name='tap-outbrain',
           "singer-python @ https://github.com/Aporia-LTD/singer-python/tarball/master#egg=package-5.13.1",
           "requests"
       ],
+      extras_require={
+          'rollups': ['numpy'],
+      },
       entry_points='''
           [console_scripts]
           tap-outbrain=tap_outbrain:main
+          tap-outbrain-decode=tap_outbrain.encoding:decode_main
+          tap-outbrain-resync=tap_outbrain:resync_main
       ''',
       packages=find_packages(),
       package_data = {
@@ -2,9 +2,18 @@
 
 from decimal import Decimal
 
+import argparse
+import collections
+import concurrent.futures
 import datetime
+import hashlib
+import heapq
+import itertools
 import json
+import math
 import os
+import sys
+import threading
 import time
 import dateutil.parser
 
@@ -16,6 +25,11 @@ from singer import utils
 from singer.catalog import Catalog, CatalogEntry
 from singer.schema import Schema
 
+import tap_outbrain.cache as cache
+import tap_outbrain.encoding as encoding
+import tap_outbrain.profiling as profiling
+import tap_outbrain.reports as reports
+import tap_outbrain.rollups as rollups
 import tap_outbrain.schemas as schemas
 
 REQUIRED_CONFIG_KEYS = []
@@ -37,6 +51,38 @@ MARKETERS_CAMPAIGNS_MAX_LIMIT = 50
 # This is an arbitrary limit and can be tuned later down the road if we
 # see need for it. (Tested with 200 at least)
 REPORTS_MARKETERS_PERIODIC_MAX_LIMIT = 100
+# Weights used when ordering campaign performance syncs, see
+# `get_campaign_priority`.
+PRIORITY_ON_AIR_WEIGHT = 4.0
+PRIORITY_ENABLED_WEIGHT = 2.0
+PRIORITY_INACTIVE_WEIGHT = 1.0
+# Outbrain allows 10 reporting requests per minute.
+REPORTS_MIN_REQUEST_INTERVAL = 6
+# Earliest time the next reporting request may start, see
+# `wait_for_report_slot`.
+NEXT_REPORT_SLOT = 0.0
+REPORT_SLOT_LOCK = threading.Lock()
+# Parallel windows fetched by `resync` by default
+RESYNC_DEFAULT_WORKERS = 4
+# Watch mode re-lists campaigns every this many polls to pick up campaigns
+# going on or off air.
+WATCH_CAMPAIGN_REFRESH_POLLS = 10
+
+# Wall-clock deadline (epoch seconds) for the run, set from the
+# `max_run_seconds` config key. `None` means unbounded.
+DEADLINE = None
+# Rolling estimate of how long a single request takes, used to decide
+# whether another request still fits before the deadline.
+REQUEST_SECONDS_ESTIMATE = 5.0
+# Seconds between retries of a failed request
+REQUEST_RETRY_INTERVAL = 30
+
+
+class DeadlineReached(Exception):
+    """
+    Raised instead of starting a request that would not finish before the
+    configured deadline.
+    """
 
 def get_abs_path(path):
     return os.path.join(os.path.dirname(os.path.realpath(__file__)), path)
@@ -78,13 +124,74 @@ def discover():
         )
     return Catalog(streams)
 
+def set_deadline(max_run_seconds):
+    # pylint: disable=global-statement
+    global DEADLINE
+    if max_run_seconds:
+        DEADLINE = time.time() + float(max_run_seconds)
+    else:
+        DEADLINE = None
+
+
+def seconds_remaining():
+    if DEADLINE is None:
+        return None
+    return DEADLINE - time.time()
+
+
+def check_deadline(reserve=0):
+    """
+    Raise `DeadlineReached` if a request (plus `reserve` seconds of extra
+    work, e.g. a rate limit sleep) no longer fits before the deadline.
+    """
+    remaining = seconds_remaining()
+    if remaining is not None and remaining < REQUEST_SECONDS_ESTIMATE + reserve:
+        raise DeadlineReached(
+            'Only {:.1f} sec left of the run budget, not starting another '
+            'request'.format(max(remaining, 0)))
+
+
+def record_request_duration(seconds):
+    # pylint: disable=global-statement
+    global REQUEST_SECONDS_ESTIMATE
+    # Exponential moving average, skewed towards recent requests.
+    REQUEST_SECONDS_ESTIMATE = 0.7 * REQUEST_SECONDS_ESTIMATE + 0.3 * seconds
+
+
+def retry_fits_deadline():
+    remaining = seconds_remaining()
+    return remaining is None or \
+        remaining >= REQUEST_RETRY_INTERVAL + REQUEST_SECONDS_ESTIMATE
+
+
+def giveup_request(exc):
+    """
+    Don't retry client errors (except 429), nor retries that would not
+    finish before the deadline.
+    """
+    return singer.requests.giveup_on_http_4xx_except_429(exc) or \
+        not retry_fits_deadline()
+
+
+def request(url, access_token, params=None, extra_headers=None):
+    try:
+        return request_with_retries(url, access_token, params, extra_headers)
+    except requests.exceptions.RequestException as exc:
+        if singer.requests.giveup_on_http_4xx_except_429(exc) or retry_fits_deadline():
+            raise
+        # Retrying was cut short by the run budget, stop cleanly instead.
+        raise DeadlineReached(
+            'Request failed with `{}` and retrying would not finish within '
+            'the run budget'.format(exc)) from exc
+
+
 @backoff.on_exception(backoff.constant,
                       (requests.exceptions.RequestException),
                       jitter=backoff.random_jitter,
                       max_tries=5,
-                      giveup=singer.requests.giveup_on_http_4xx_except_429,
-                      interval=30)
-def request(url, access_token, params=None):
+                      giveup=giveup_request,
+                      interval=REQUEST_RETRY_INTERVAL)
+def request_with_retries(url, access_token, params=None, extra_headers=None):
     # Optional query parameters
     if params is None:
         params = dict()
@@ -93,10 +200,17 @@ def request(url, access_token, params=None):
     headers = {'OB-TOKEN-V1': access_token}
     if 'user_agent' in CONFIG:
         headers['User-Agent'] = CONFIG['user_agent']
+    if extra_headers:
+        headers.update(extra_headers)
+
+    check_deadline()
 
     req = requests.Request('GET', url, headers=headers, params=params).prepare()
     LOGGER.info("GET {}".format(req.url))
-    resp = SESSION.send(req)
+    request_start = time.time()
+    with profiling.stage('request'):
+        resp = SESSION.send(req)
+    record_request_duration(time.time() - request_start)
 
     if resp.status_code >= 400:
         LOGGER.error("GET {} [{} - {}]".format(req.url, resp.status_code, resp.content))
@@ -105,6 +219,34 @@ def request(url, access_token, params=None):
     return resp
 
 
+def request_json_cached(url, access_token, params=None):
+    """
+    GET a JSON payload through the entity cache. Falls back to a plain
+    request when the cache is disabled.
+
+    Returned bodies may be shared with the cache and must not be mutated.
+    """
+    key = cache.cache_key(url, params)
+    entry = cache.lookup(key)
+
+    resp = request(url, access_token, params, cache.conditional_headers(entry))
+    with resp:
+        if resp.status_code == 304 and entry is not None:
+            LOGGER.info('Not modified, using cached {}'.format(key))
+            return cache.hit(entry)
+
+        content_hash = hashlib.sha256(resp.content).hexdigest()
+        if entry is not None and entry.get('hash') == content_hash:
+            LOGGER.info('Unchanged payload, using cached {}'.format(key))
+            return cache.hit(entry)
+
+        with profiling.stage('decode_json'):
+            body = resp.json()
+
+    cache.store(key, resp.headers, content_hash, body)
+    return body
+
+
 def generate_token(username, password):
     LOGGER.info("Generating new token using basic auth.")
 
@@ -117,19 +259,19 @@ def generate_token(username, password):
 
 
 def parse_datetime(date_time):
-    parsed_datetime = dateutil.parser.parse(date_time)
+    with profiling.stage('parse_datetime'):
+        parsed_datetime = dateutil.parser.parse(date_time)
 
     # the assumption is that the timestamp comes in in UTC
     return parsed_datetime.isoformat('T') + 'Z'
 
 
-def parse_performance(result, extra_fields):
+def parse_performance(result, extra_fields, dimensions=('fromDate',)):
     metrics = result.get('metrics', {})
     metadata = result.get('metadata', {})
-    from_date = metadata.get('fromDate')
 
-    to_return = {
-        'fromDate': from_date,
+    to_return = {dimension: metadata.get(dimension) for dimension in dimensions}
+    to_return.update({
         'impressions': int(metrics.get('impressions', 0)),
         'clicks': int(metrics.get('clicks', 0)),
         'ctr': float(metrics.get('ctr', 0.0)),
@@ -138,7 +280,7 @@ def parse_performance(result, extra_fields):
         'conversions': int(metrics.get('conversions', 0)),
         'conversionRate': float(metrics.get('conversionRate', 0.0)),
         'cpa': float(metrics.get('cpa', 0.0)),
-    }
+    })
     to_return.update(extra_fields)
 
     return to_return
@@ -165,123 +307,223 @@ def get_date_ranges(start, end, interval_in_days):
     return to_return
 
 
+def validate_report_streams(config):
+    unknown_streams = set(config.get('report_streams', [])) - set(reports.REPORT_STREAMS)
+    if unknown_streams:
+        LOGGER.fatal("Unknown report_streams {}, expected some of {}.".format(
+            sorted(unknown_streams), sorted(reports.REPORT_STREAMS)))
+        raise RuntimeError
+
+
+def get_report_streams():
+    return [reports.REPORT_STREAMS[name] for name
+            in CONFIG.get('report_streams', reports.DEFAULT_REPORT_STREAMS)]
+
+
 def sync_campaign_performance(state, access_token, account_id, campaign_id, extra_data={}):
-    return sync_performance(
+    return sync_report_streams(
         state,
         access_token,
         account_id,
-        'campaign_performance',
         campaign_id,
         {'campaignId': campaign_id, **extra_data},
-        {'campaignId': campaign_id, **extra_data})
-
-
-def sync_performance(state, access_token, account_id, table_name, state_sub_id,
-                     extra_params, extra_persist_fields):
-    """
-    This function is heavily parameterized as it is used to sync performance
-    both based on campaign ID alone, and by campaign ID and link ID.
-
-    - `state`: state map
-    - `access_token`: access token for Outbrain Amplify API
-    - `account_id`: Outbrain marketer ID
-    - `table_name`: the table name to use. At present:
-      `campaign_performance`
-    - `state_sub_id`: the id to use within the state map to identify this
-                      sub-object. For example,
-
-                        state['campaign_performance'][state_sub_id]
+        get_report_streams())
 
-                      is used for the `campaign_performance` table.
-    - `extra_params`: extra params sent to the Outbrain API
-    - `extra_persist_fields`: extra fields pushed into the destination data.
-                              For example:
 
-                                {'campaignId': '000b...'}
-    """
+def get_sync_start(state, stream, state_sub_id):
     # sync 2 days before last saved date, or START_DATE
-    from_date = datetime.datetime.strptime(
-        state.get(table_name, {})
+    return datetime.datetime.strptime(
+        state.get(stream.name, {})
             .get(state_sub_id, START_DATE),
         '%Y-%m-%d').date() - datetime.timedelta(days=2)
 
+
+def get_performance_date_ranges(state, stream, state_sub_id):
+    from_date = get_sync_start(state, stream, state_sub_id)
+
+    if stream.feeds_rollups:
+        # Rollups need every day of the periods they touch
+        from_date = rollups.align_start(from_date)
+
     to_date = datetime.date.today()
 
     interval_in_days = REPORTS_MARKETERS_PERIODIC_MAX_LIMIT
 
-    date_ranges = get_date_ranges(from_date, to_date, interval_in_days)
+    return get_date_ranges(from_date, to_date, interval_in_days)
 
-    last_request_start = None
 
-    LOGGER.info('Iterating through date ranges: {}'.format(str(date_ranges)))
+def get_report_windows(state, state_sub_id, streams):
+    """
+    Map every date window that needs syncing to the streams that need it,
+    ordered by date. Streams whose bookmarks line up share their windows.
+    """
+    windows = collections.defaultdict(list)
+    for stream in streams:
+        for date_range in get_performance_date_ranges(state, stream, state_sub_id):
+            windows[(date_range.get('from_date'), date_range.get('to_date'))].append(stream)
+    return collections.OrderedDict(sorted(windows.items()))
+
 
-    for date_range in date_ranges:
+def wait_for_report_slot():
+    """
+    Block until another reporting request is allowed. Outbrain limits the
+    reporting API to 10 requests per minute per token, so request starts
+    are spaced `REPORTS_MIN_REQUEST_INTERVAL` apart. Slots are reserved under
+    a lock so this also holds across threads.
+    """
+    # pylint: disable=global-statement
+    global NEXT_REPORT_SLOT
+
+    with REPORT_SLOT_LOCK:
+        now = time.time()
+        slot = max(now, NEXT_REPORT_SLOT)
+        to_sleep = slot - now
+        if to_sleep > 0:
+            # Don't sleep just to find out the request no longer fits.
+            check_deadline(reserve=to_sleep)
+        NEXT_REPORT_SLOT = slot + REPORTS_MIN_REQUEST_INTERVAL
+
+    if to_sleep > 0:
         LOGGER.info(
-            'Pulling {} for {} from {} to {}'
-                .format(table_name,
-                        extra_persist_fields,
-                        date_range.get('from_date'),
-                        date_range.get('to_date')))
+            'Limiting to 10 requests per minute. Sleeping {} sec '
+            'before making the next reporting request.'
+                .format(to_sleep))
+        with profiling.stage('rate_limit_sleep'):
+            time.sleep(to_sleep)
+
 
+def get_report(access_token, account_id, stream, from_date, to_date, extra_params):
+    """
+    Request one window of a report stream, following pagination, and return
+    the raw results along with the time they were extracted.
+    """
+    results = []
+    offset = 0
+
+    while True:
         params = {
-            'from': date_range.get('from_date'),
-            'to': date_range.get('to_date'),
-            'breakdown': 'daily',
+            'from': from_date,
+            'to': to_date,
             'limit': REPORTS_MARKETERS_PERIODIC_MAX_LIMIT,
-            'sort': '+fromDate',
-            'includeArchivedCampaigns': True,
+            'offset': offset,
+            'breakdown': stream.breakdown,
         }
+        params.update(stream.params)
         params.update(extra_params)
 
+        wait_for_report_slot()
+
         last_request_start = utils.now()
         raw_response = request(
-            '{}/reports/marketers/{}/periodic'.format(BASE_URL, account_id),
+            '{}/{}'.format(BASE_URL, stream.path.format(account_id=account_id)),
             access_token,
             params)
-        with raw_response:
+        with raw_response, profiling.stage('decode_json'):
             response = raw_response.json()
-        
-        if REPORTS_MARKETERS_PERIODIC_MAX_LIMIT < response.get('totalResults'):
-            LOGGER.warn(
-                'More performance data (`{}`) than the tap can currently retrieve (`{}`)'.format(
-                    response.get('totalResults'), REPORTS_MARKETERS_PERIODIC_MAX_LIMIT))
-        else:
-            LOGGER.info(
-                'Syncing `{}` rows of performance data for campaign `{}`. Requested `{}`.'.format(
-                    response.get('totalResults'), state_sub_id,
-                    REPORTS_MARKETERS_PERIODIC_MAX_LIMIT))
         last_request_end = utils.now()
 
-        LOGGER.info('Done in {} sec'.format(
-            last_request_end.timestamp() - last_request_start.timestamp()))
+        # Pages count entities for nested responses, see `reports.flatten_results`
+        page = response.get(stream.results_key) or []
+        results.extend(reports.flatten_results(stream, page))
+        total_results = response.get('totalResults') or 0
 
-        performance = [
-            parse_performance(result, extra_persist_fields)
-            for result in response.get('results')]
+        LOGGER.info(
+            'Retrieved `{}` of `{}` rows of {} for `{}` {} in {} sec'.format(
+                len(results), total_results, stream.name, account_id,
+                extra_params,
+                last_request_end.timestamp() - last_request_start.timestamp()))
 
-        for record in performance:
-            singer.write_record(table_name, record, time_extracted=last_request_end)
+        offset += REPORTS_MARKETERS_PERIODIC_MAX_LIMIT
+        if not page or offset >= total_results:
+            return results, last_request_end
 
-        last_record = performance[-1]
-        new_from_date = last_record.get('fromDate')
 
-        state[table_name][state_sub_id] = new_from_date
-        singer.write_state(state)
+def get_report_records(access_token, account_id, scope_id, streams,
+                       from_date, to_date, extra_persist_fields):
+    """
+    Fetch one window of `streams` for `scope_id` (see `reports.SCOPES`) and
+    yield `(stream, records, time_extracted)` for each of them. Streams with
+    the same request (see `reports.request_key`) share one paginated, rate
+    limited request.
+    """
+    responses = {}
 
-        from_date = new_from_date
+    for stream in streams:
+        LOGGER.info(
+            'Pulling {} for {} from {} to {}'
+                .format(stream.name, extra_persist_fields, from_date, to_date))
 
-        if last_request_start is not None and \
-                (time.time() - last_request_end.timestamp()) < 6:
-            to_sleep = 6 - (time.time() - last_request_end.timestamp())
-            LOGGER.info(
-                'Limiting to 10 requests per minute. Sleeping {} sec '
-                'before making the next reporting request.'
-                    .format(to_sleep))
-            time.sleep(to_sleep)
+        key = reports.request_key(stream)
+        if key not in responses:
+            responses[key] = get_report(access_token, account_id, stream,
+                                        from_date, to_date,
+                                        reports.scope_params(stream, scope_id))
+        results, time_extracted = responses[key]
+
+        with profiling.stage('parse_performance'):
+            records = [
+                parse_performance(result, extra_persist_fields, stream.dimensions)
+                for result in results]
+
+        yield stream, records, time_extracted
+
+
+def sync_report_streams(state, access_token, account_id, state_sub_id,
+                        extra_persist_fields, streams):
+    """
+    Sync the report `streams` of one campaign, or one marketer for
+    marketer scoped streams, through a shared pipeline.
+
+    - `state`: state map, bookmarks are kept in
+
+                        state[stream.name][state_sub_id]
+
+    - `access_token`: access token for Outbrain Amplify API
+    - `account_id`: Outbrain marketer ID
+    - `state_sub_id`: the ID of the streams' scope (see `reports.SCOPES`),
+                      i.e. the campaign ID sent as the `campaignId` parameter
+    - `extra_persist_fields`: extra fields pushed into the destination data.
+                              For example:
+
+                                {'campaignId': '000b...'}
+    - `streams`: `reports.ReportStream` definitions to sync
+
+    Windows are walked in date order, see `get_report_records`.
+    """
+    windows = get_report_windows(state, state_sub_id, streams)
+    # Windows of streams feeding the rollups start earlier (see
+    # `rollups.align_start`), the extra rows only go to the rollups.
+    emit_from = {stream.name: get_sync_start(state, stream, state_sub_id).isoformat()
+                 for stream in streams}
+
+    LOGGER.info('Iterating through date ranges: {}'.format(list(windows)))
+
+    for (from_date, to_date), window_streams in windows.items():
+        for stream, records, time_extracted in get_report_records(
+                access_token, account_id, state_sub_id, window_streams,
+                from_date, to_date, extra_persist_fields):
+            with profiling.stage('write_record'):
+                for record in records:
+                    if record.get('fromDate') >= emit_from[stream.name]:
+                        singer.write_record(stream.name, record, time_extracted=time_extracted)
+
+            # Buffered per window, so windows completed before a run is cut
+            # short still reach the rollups.
+            if stream.feeds_rollups:
+                rollups.add_rows(account_id, state_sub_id, from_date, to_date, records)
+
+            if records:
+                state.setdefault(stream.name, {})[state_sub_id] = max(
+                    record.get('fromDate') for record in records)
+                singer.write_state(state)
 
 
 def parse_campaign(campaign):
+    # Copy rather than update in place, the raw campaign may be shared with
+    # the entity cache.
+    campaign = dict(campaign)
     if campaign.get('budget') is not None:
+        campaign['budget'] = dict(campaign['budget'])
         campaign['budget']['creationTime'] = parse_datetime(
             campaign.get('budget').get('creationTime'))
         campaign['budget']['lastModified'] = parse_datetime(
@@ -293,15 +535,13 @@ def parse_campaign(campaign):
 def get_campaigns_page(account_id, access_token, offset):
     # NOTE: We probably should be more aggressive about ensuring that the
     # response was successful.
-    resp = request(
+    return request_json_cached(
         '{}/marketers/{}/campaigns'.format(BASE_URL, account_id),
         access_token, {'limit': MARKETERS_CAMPAIGNS_MAX_LIMIT,
                        'offset': offset})
-    with resp:
-        return resp.json()
 
 
-def get_campaign_pages(account_id, access_token):
+def get_campaign_pages(account_id, access_token, enforce_ceiling=True):
     more_campaigns = True
     offset = 0
 
@@ -309,9 +549,12 @@ def get_campaign_pages(account_id, access_token):
         LOGGER.info('Retrieving campaigns from offset `{}`'.format(
             offset))
         campaign_page = get_campaigns_page(account_id, access_token, offset)
-        if TAP_CAMPAIGN_COUNT_ERROR_CEILING < campaign_page.get('totalCount'):
-            msg = 'Tap found `{}` campaigns which is more than can be retrieved in the alloted time (`{}`).'.format(
-                campaign_page.get('totalCount'), TAP_CAMPAIGN_COUNT_ERROR_CEILING)
+        # Each shard only syncs its share of the campaigns
+        shard_campaigns = campaign_page.get('totalCount') / int(CONFIG.get('shard_count', 1))
+        if enforce_ceiling and TAP_CAMPAIGN_COUNT_ERROR_CEILING < shard_campaigns \
+                and DEADLINE is None:
+            msg = 'Tap found `{}` campaigns for this shard which is more than can be retrieved in the alloted time (`{}`).'.format(
+                int(shard_campaigns), TAP_CAMPAIGN_COUNT_ERROR_CEILING)
             LOGGER.error(msg)
             raise Exception(msg)
         LOGGER.info('Retrieved offset `{}` campaigns out of `{}`'.format(
@@ -326,29 +569,265 @@ def get_campaign_pages(account_id, access_token):
         campaign_page.get('totalCount')))
 
 
-def sync_campaign_page(state, access_token, account_id, campaign_page):
+def get_campaign_priority(state, campaign, today=None):
+    """
+    Score a campaign for performance syncing. Higher scores are synced first.
+
+    The score combines:
+
+    - how stale the `campaign_performance` bookmark is (in days, at least 1)
+    - the campaign budget, damped with `log1p` so a single huge budget does
+      not starve everything else
+    - whether the campaign is on air, enabled, or neither
+    """
+    if today is None:
+        today = datetime.date.today()
+
+    bookmark = state.get('campaign_performance', {}).get(
+        campaign.get('id'), START_DATE)
+    bookmark_date = datetime.datetime.strptime(bookmark, '%Y-%m-%d').date()
+    age_in_days = max((today - bookmark_date).days, 1)
+
+    budget = campaign.get('budget') or {}
+    amount = budget.get('amountRemaining', budget.get('amount')) or 0.0
+    budget_weight = 1.0 + math.log1p(max(float(amount), 0.0))
+
+    if campaign.get('campaignOnAir'):
+        activity_weight = PRIORITY_ON_AIR_WEIGHT
+    elif campaign.get('enabled'):
+        activity_weight = PRIORITY_ENABLED_WEIGHT
+    else:
+        activity_weight = PRIORITY_INACTIVE_WEIGHT
+
+    return age_in_days * budget_weight * activity_weight
+
+
+def get_shard(campaign_id, shard_count):
+    """
+    Map a campaign ID to a shard. Uses a stable hash (not `hash()`, which is
+    salted per process) so every tap instance agrees on the split.
+    """
+    digest = hashlib.md5(str(campaign_id).encode('utf-8')).hexdigest()
+    return int(digest, 16) % shard_count
+
+
+def campaign_in_shard(campaign_id):
+    shard_count = int(CONFIG.get('shard_count', 1))
+    if shard_count <= 1:
+        return True
+    return get_shard(campaign_id, shard_count) == int(CONFIG.get('shard_index', 0))
+
+
+def sync_campaign_page(campaign_page):
+    """
+    Emit the campaigns of a page that belong to this shard and return them
+    for performance syncing.
+    """
     campaigns = [parse_campaign(campaign) for campaign
-                 in campaign_page.get('campaigns', [])]
+                 in campaign_page.get('campaigns', [])
+                 if campaign_in_shard(campaign.get('id'))]
 
     for campaign in campaigns:
-        singer.write_record('campaign', campaign,
-                            time_extracted=utils.now())
-        sync_campaign_performance(state, access_token, account_id,
-                                  campaign.get('id'), {'campaignName': campaign.get('name')})
+        with profiling.stage('write_record'):
+            singer.write_record('campaign', campaign,
+                                time_extracted=utils.now())
 
+    return campaigns
 
-def sync_campaigns(state, access_token, account_id):
-    LOGGER.info(f'sync_campaigns: Syncing campaigns for marketer account {account_id}')
-    campaign_pages = list(get_campaign_pages(account_id, access_token)) # de-iterate for logging
 
-    LOGGER.info(f'Found {len(campaign_pages)} for account {account_id}, getting performance reports..')
+def plan_campaign_batch(state, queue):
+    """
+    Pop the highest priority campaigns whose reporting requests fit in the
+    remaining run budget. Without a budget, all of them. The first campaign
+    is always taken while at least one request fits, so that a campaign
+    larger than the budget still makes progress window by window.
 
-    for campaign_page in campaign_pages:
-        sync_campaign_page(state, access_token, account_id, campaign_page)
+    Re-planned after each batch, as the request duration estimate changes.
+    """
+    remaining = seconds_remaining()
+    if remaining is None:
+        return [heapq.heappop(queue) for _ in range(len(queue))]
+
+    request_seconds = REQUEST_SECONDS_ESTIMATE + REPORTS_MIN_REQUEST_INTERVAL
+    budget = int(max(remaining, 0) // request_seconds)
+    report_streams = get_report_streams()
+
+    batch = []
+    planned = 0
+    while queue and budget > 0:
+        campaign = queue[0][3]
+        needed = len(get_report_windows(state, campaign.get('id'), report_streams))
+        if batch and planned + needed > budget:
+            break
+        batch.append(heapq.heappop(queue))
+        planned += needed
+
+    LOGGER.info('Planned {} campaigns ({} reporting requests) for the remaining '
+                '{:.0f} sec of the run budget, {} campaigns left'.format(
+                    len(batch), planned, remaining, len(queue)))
+    return batch
+
+
+def sync_campaigns(state, access_token, account_ids):
+    """
+    Emit the campaigns of every account, then sync their performance in
+    priority order across all accounts, so that stale, high-spend, active
+    campaigns are reached first if the run is cut short.
+    """
+    queue = []
+    # The counter breaks ties in API page order.
+    counter = itertools.count()
+    pending = collections.Counter()
+
+    for account_id in account_ids:
+        LOGGER.info(f'sync_campaigns: Syncing campaigns for marketer account {account_id}')
+        for campaign_page in get_campaign_pages(account_id, access_token):
+            for campaign in sync_campaign_page(campaign_page):
+                priority = get_campaign_priority(state, campaign)
+                heapq.heappush(queue, (-priority, next(counter), account_id, campaign))
+                pending[account_id] += 1
+
+    LOGGER.info(f'Found {len(queue)} campaigns in {len(account_ids)} accounts, getting performance reports..')
+
+    try:
+        while queue:
+            batch = plan_campaign_batch(state, queue)
+            if not batch:
+                LOGGER.warning('Deferring {} campaigns to the next run, their '
+                               'requests no longer fit in the run budget'.format(len(queue)))
+                break
+
+            for neg_priority, _, account_id, campaign in batch:
+                LOGGER.info('Syncing performance for campaign `{}` of `{}` (priority {:.2f})'
+                            .format(campaign.get('id'), account_id, -neg_priority))
+                sync_campaign_performance(state, access_token, account_id,
+                                          campaign.get('id'), {'campaignName': campaign.get('name')})
+                pending[account_id] -= 1
+                if pending[account_id] == 0:
+                    rollups.flush(account_id)
+    finally:
+        # Accounts whose campaigns did not all sync, or that had none
+        for account_id in account_ids:
+            rollups.flush(account_id, complete=pending[account_id] == 0)
 
     LOGGER.info('sync_campaigns: Done!')
 
 
+def get_active_campaigns(access_token, account_ids):
+    """
+    List the on-air campaigns of this shard for every account, without
+    emitting `campaign` records.
+    """
+    active_campaigns = []
+    for account_id in account_ids:
+        # The campaign count ceiling guards full syncs, watch mode only
+        # polls today's rows.
+        for campaign_page in get_campaign_pages(account_id, access_token,
+                                                enforce_ceiling=False):
+            active_campaigns.extend(
+                (account_id, campaign)
+                for campaign in campaign_page.get('campaigns', [])
+                if campaign.get('campaignOnAir')
+                and campaign_in_shard(campaign.get('id')))
+
+    LOGGER.info('Watching {} active campaigns'.format(len(active_campaigns)))
+    return active_campaigns
+
+
+def write_changed_records(last_seen, stream, records, time_extracted):
+    """
+    Emit the `records` that differ from the last emitted version of the same
+    row and return how many were emitted.
+    """
+    changed = 0
+    for record in records:
+        key = (stream.name, record.get('fromDate')) + tuple(
+            record.get(key_property) for key_property in stream.key_properties)
+        if last_seen.get(key) == record:
+            continue
+        last_seen[key] = record
+        changed += 1
+        with profiling.stage('write_record'):
+            singer.write_record(stream.name, record, time_extracted=time_extracted)
+    return changed
+
+
+def watch(access_token, account_ids, interval):
+    """
+    Poll today's rows of the report streams of every active campaign every
+    `interval` seconds and emit only the rows that changed since the last
+    poll. Bookmarks are left untouched, regular syncs own those.
+
+    Streams with a marketer scoped equivalent (see
+    `reports.MARKETER_REPORT_STREAMS`) cost one request per marketer and
+    poll, others one request per campaign and poll. As reporting requests
+    are rate limited, a poll can take longer than `interval`, polls then
+    run back to back.
+
+    Runs until the run budget (`max_run_seconds`) is exhausted, or forever.
+    """
+    last_seen = {}
+    active_campaigns = []
+    report_streams = get_report_streams()
+    marketer_streams = [reports.MARKETER_REPORT_STREAMS[stream.name]
+                        for stream in report_streams
+                        if stream.name in reports.MARKETER_REPORT_STREAMS]
+    campaign_streams = [stream for stream in report_streams
+                        if stream.name not in reports.MARKETER_REPORT_STREAMS]
+
+    for poll in itertools.count():
+        poll_start = time.time()
+        today = datetime.date.today()
+
+        if poll % WATCH_CAMPAIGN_REFRESH_POLLS == 0:
+            active_campaigns = get_active_campaigns(access_token, account_ids)
+
+        campaigns_by_account = collections.OrderedDict()
+        for account_id, campaign in active_campaigns:
+            campaigns_by_account.setdefault(account_id, {})[campaign.get('id')] = campaign
+
+        changed = 0
+        for account_id, campaigns in campaigns_by_account.items():
+            if marketer_streams:
+                for stream, records, time_extracted in get_report_records(
+                        access_token, account_id, account_id, marketer_streams,
+                        today, today, {}):
+                    # The report covers every campaign of the marketer, keep
+                    # the active ones of this shard.
+                    records = [record for record in records
+                               if record.get('campaignId') in campaigns]
+                    changed += write_changed_records(last_seen, stream, records,
+                                                     time_extracted)
+
+            if not campaign_streams:
+                continue
+            for campaign_id, campaign in campaigns.items():
+                extra_data = {'campaignId': campaign_id,
+                              'campaignName': campaign.get('name')}
+                for stream, records, time_extracted in get_report_records(
+                        access_token, account_id, campaign_id, campaign_streams,
+                        today, today, extra_data):
+                    changed += write_changed_records(last_seen, stream, records,
+                                                     time_extracted)
+
+        # Forget previous days so the process can stay up indefinitely.
+        today_str = today.isoformat()
+        last_seen = {key: record for key, record in last_seen.items()
+                     if key[1] == today_str}
+
+        poll_seconds = time.time() - poll_start
+        LOGGER.info('Watch poll {} done in {:.0f} sec, {} changed rows'.format(
+            poll, poll_seconds, changed))
+        if poll_seconds > interval:
+            LOGGER.warning('Watch poll {} took {:.0f} sec, longer than the {} sec '
+                           'watch interval'.format(poll, poll_seconds, interval))
+
+        to_sleep = interval - poll_seconds
+        if to_sleep > 0:
+            check_deadline(reserve=to_sleep)
+            time.sleep(to_sleep)
+
+
 def parse_marketer(marketer):
     return {
         'id': str(marketer['id']),
@@ -369,9 +848,7 @@ def get_marketers(access_token):
 
     url = '{}/marketers'.format(BASE_URL)
 
-    marketers_resp = request(url, access_token)
-    with marketers_resp:
-        marketers = marketers_resp.json()['marketers']
+    marketers = request_json_cached(url, access_token)['marketers']
 
     LOGGER.info('Retrieved %s marketers', len(marketers))
 
@@ -389,21 +866,15 @@ def sync_marketers(access_token):
 
     # Emit rows
     for marketer in marketers:
-        singer.write_record('marketer', marketer, time_extracted=utils.now())
+        with profiling.stage('write_record'):
+            singer.write_record('marketer', marketer, time_extracted=utils.now())
 
     LOGGER.info('sync_marketers: Done!')
 
     return marketers
 
 
-def sync(config, state = None, catalog = None):
-    # pylint: disable=global-statement
-    global START_DATE
-    if not state:
-        state = DEFAULT_STATE
-
-    CONFIG.update(config)
-
+def get_access_token(config):
     missing_keys = []
     if 'username' not in config:
         missing_keys.append('username')
@@ -417,11 +888,6 @@ def sync(config, state = None, catalog = None):
 
     if 'account_id' not in config:
         missing_keys.append('account_id')
-    else:
-        account_id = config['account_id']
-
-    if 'start_date' in config:
-        START_DATE = config['start_date'][:10]
 
     access_token = config.get('access_token')
 
@@ -438,6 +904,68 @@ def sync(config, state = None, catalog = None):
     # NEVER RAISE THIS ABOVE DEBUG!
     LOGGER.debug('Using access token `{}`'.format(access_token))
 
+    return access_token
+
+
+def write_rollup_schemas():
+    for stream_name in rollups.STREAMS:
+        if rollups.ROLLUP_STREAMS[stream_name][0] == 'campaign':
+            rollup_schema = schemas.campaign_performance_rollup
+        else:
+            rollup_schema = schemas.marketer_performance_rollup
+        singer.write_schema(stream_name,
+                            rollup_schema,
+                            key_properties=rollups.key_properties(stream_name))
+
+
+def sync(config, state = None, catalog = None):
+    # pylint: disable=global-statement
+    global START_DATE
+    if not state:
+        state = DEFAULT_STATE
+
+    CONFIG.update(config)
+
+    if 'start_date' in config:
+        START_DATE = config['start_date'][:10]
+
+    set_deadline(config.get('max_run_seconds'))
+
+    encoding.enable(config.get('output_encoding', 'json'))
+
+    if config.get('entity_cache_path'):
+        cache.load(config['entity_cache_path'])
+
+    shard_index = int(config.get('shard_index', 0))
+    shard_count = int(config.get('shard_count', 1))
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        LOGGER.fatal("Invalid shard_index `{}` for shard_count `{}`.".format(
+            shard_index, shard_count))
+        raise RuntimeError
+
+    previous_shard = state.get('shard')
+    if previous_shard is not None and \
+            previous_shard.get('count') != shard_count:
+        # Bookmarks are keyed by campaign ID, so campaigns moving between
+        # shards start over from START_DATE in their new shard's state.
+        LOGGER.warning('shard_count changed from {} to {}, campaigns may be '
+                       'resynced from the start date'.format(
+                           previous_shard.get('count'), shard_count))
+    if shard_count > 1:
+        state['shard'] = {'index': shard_index, 'count': shard_count}
+        LOGGER.info('Running as shard {} of {}'.format(shard_index, shard_count))
+    else:
+        state.pop('shard', None)
+
+    validate_report_streams(config)
+
+    if config.get('rollups'):
+        rollups.enable(config['rollups'])
+        if shard_count > 1:
+            rollups.disable_marketer_rollups('each shard only sees part of a marketer')
+
+    access_token = get_access_token(config)
+
     for stream in catalog.get_selected_streams(state):
         LOGGER.info("Syncing stream:" + stream.tap_stream_id)
     LOGGER.info(f'Writing schemas and starting full sync..')
@@ -446,24 +974,245 @@ def sync(config, state = None, catalog = None):
     singer.write_schema('campaign',
                         schemas.campaign,
                         key_properties=["id"])
-    singer.write_schema('campaign_performance',
-                        schemas.campaign_performance,
-                        key_properties=["campaignId", "fromDate"],
-                        bookmark_properties=["fromDate"])
+    for report_stream in get_report_streams():
+        singer.write_schema(report_stream.name,
+                            report_stream.schema,
+                            key_properties=report_stream.key_properties,
+                            bookmark_properties=["fromDate"])
+    write_rollup_schemas()
+
+    try:
+        # Retrieve all accounts that the authenticated account has access to.
+        # Only the first shard emits marketers to avoid duplicate records.
+        if shard_index == 0:
+            marketers = sync_marketers(access_token)
+        else:
+            marketers = list(map(parse_marketer, get_marketers(access_token)))
+
+        account_ids_to_iterate = list(config.get('account_ids', [marketer['id'] for marketer in marketers]))
+        LOGGER.info(f"Iterating {len(account_ids_to_iterate)} marketer accounts ({account_ids_to_iterate})")
+
+        # Iterate over all these customer accounts
+        if config.get('watch_interval_seconds'):
+            watch(access_token, account_ids_to_iterate,
+                  float(config['watch_interval_seconds']))
+        else:
+            sync_campaigns(state, access_token, account_ids_to_iterate)
+    except DeadlineReached as exc:
+        # Every completed window has already been bookmarked, so the next
+        # run picks up where this one stopped.
+        LOGGER.warning('Stopping early: {}'.format(exc))
+    finally:
+        cache.save()
+
+    singer.write_state(state)
+
+def resync(config, marketer_ids, campaign_ids, from_date, to_date,
+           workers=RESYNC_DEFAULT_WORKERS):
+    """
+    Re-emit the report streams of selected campaigns for a date range,
+    e.g. after Outbrain restated data. No state is read or written, so
+    bookmarks are left alone.
+
+    With `rollups` configured, the fetched range is widened to whole
+    periods (see `rollups.align_start`/`align_end`) and the rollups of the
+    touched periods are emitted again; the extra days only feed the
+    rollups. Marketer rollups need every campaign of a marketer, so they
+    are only emitted when resyncing all of them.
+
+    - `marketer_ids`: marketers whose campaigns are resynced
+    - `campaign_ids`: campaigns to resync, all campaigns of the marketers
+                      if empty
+    - `from_date`, `to_date`: inclusive `datetime.date` range
+    - `workers`: number of windows fetched in parallel. All requests still
+                 go through the shared rate limiter, the parallelism only
+                 overlaps request latency with the rate limit spacing.
+    """
+    CONFIG.update(config)
+    validate_report_streams(config)
+    set_deadline(config.get('max_run_seconds'))
+    encoding.enable(config.get('output_encoding', 'json'))
+    if config.get('entity_cache_path'):
+        cache.load(config['entity_cache_path'])
+
+    if config.get('rollups'):
+        rollups.enable(config['rollups'])
+        if campaign_ids:
+            rollups.disable_marketer_rollups('only some campaigns are resynced')
+
+    access_token = get_access_token(config)
+    report_streams = get_report_streams()
+    for report_stream in report_streams:
+        singer.write_schema(report_stream.name,
+                            report_stream.schema,
+                            key_properties=report_stream.key_properties)
+    write_rollup_schemas()
+
+    fetch_to = rollups.align_end(to_date)
+    date_ranges = [
+        {'from_date': date_range.get('from_date'),
+         'to_date': min(date_range.get('to_date'), fetch_to)}
+        for date_range in get_date_ranges(rollups.align_start(from_date),
+                                          fetch_to + datetime.timedelta(days=1),
+                                          REPORTS_MARKETERS_PERIODIC_MAX_LIMIT)]
+    # (account ID, campaign ID) -> {window: records} of streams feeding the
+    # rollups, added in date order once all windows of the campaign completed.
+    rollup_windows = collections.defaultdict(dict)
+    campaigns = []
+
+    try:
+        # Look up the campaigns to get their names and check they exist, the
+        # campaign lists are cheap with the entity cache. The campaign count
+        # ceiling guards full syncs, a resync only fetches the requested range.
+        wanted = set(campaign_ids)
+        for account_id in marketer_ids:
+            for campaign_page in get_campaign_pages(account_id, access_token,
+                                                    enforce_ceiling=False):
+                campaigns.extend(
+                    (account_id, campaign)
+                    for campaign in campaign_page.get('campaigns', [])
+                    if not wanted or campaign.get('id') in wanted)
+        missing = wanted - {campaign.get('id') for _, campaign in campaigns}
+        if missing:
+            LOGGER.warning('Campaigns {} not found for marketers {}'.format(
+                sorted(missing), marketer_ids))
+
+        # One job per distinct request, see `reports.request_key`
+        streams_by_request = collections.defaultdict(list)
+        for report_stream in report_streams:
+            streams_by_request[reports.request_key(report_stream)].append(report_stream)
+
+        jobs = [(account_id, campaign, date_range, request_streams)
+                for account_id, campaign in campaigns
+                for date_range in date_ranges
+                for request_streams in streams_by_request.values()]
+        LOGGER.info('Resyncing {} campaigns from {} to {} in {} requests'.format(
+            len(campaigns), from_date, to_date, len(jobs)))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(get_report, access_token, account_id, request_streams[0],
+                                date_range.get('from_date'), date_range.get('to_date'),
+                                reports.scope_params(request_streams[0], campaign.get('id'))):
+                    (account_id, campaign, date_range, request_streams)
+                for account_id, campaign, date_range, request_streams in jobs}
+
+            # Records are emitted from this thread only, so messages on stdout
+            # never interleave.
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    account_id, campaign, date_range, request_streams = futures[future]
+                    results, time_extracted = future.result()
+                    extra_fields = {'campaignId': campaign.get('id'),
+                                    'campaignName': campaign.get('name')}
+                    for report_stream in request_streams:
+                        with profiling.stage('parse_performance'):
+                            records = [
+                                parse_performance(result, extra_fields, report_stream.dimensions)
+                                for result in results]
+                        with profiling.stage('write_record'):
+                            for record in records:
+                                if from_date.isoformat() <= record.get('fromDate') <= to_date.isoformat():
+                                    singer.write_record(report_stream.name, record,
+                                                        time_extracted=time_extracted)
+                        if report_stream.feeds_rollups:
+                            rollup_windows[(account_id, campaign.get('id'))][
+                                (date_range.get('from_date'), date_range.get('to_date'))] = records
+            except BaseException:
+                # Don't wait for the queued windows before stopping
+                for future in futures:
+                    future.cancel()
+                raise
+    except DeadlineReached as exc:
+        LOGGER.warning('Stopping resync early: {}'.format(exc))
+    finally:
+        cache.save()
+
+    if rollups.ENABLED:
+        flush_resync_rollups(rollup_windows, campaigns, len(date_ranges))
+
+    LOGGER.info('Resync: Done!')
+
+
+def flush_resync_rollups(rollup_windows, campaigns, window_count):
+    """
+    Feed the rollups with the campaigns of which every window was fetched,
+    in date order, and emit them per account. Periods of campaigns cut off
+    by the deadline are left alone.
+    """
+    complete = collections.defaultdict(lambda: True)
+    for account_id, campaign in campaigns:
+        windows = rollup_windows.get((account_id, campaign.get('id')), {})
+        if len(windows) < window_count:
+            complete[account_id] = False
+            continue
+        for (window_from, window_to), records in sorted(windows.items()):
+            rollups.add_rows(account_id, campaign.get('id'), window_from, window_to, records)
 
-    # Retrieve all accounts that the authenticated account has access to
-    marketers = sync_marketers(access_token)
+    for account_id in collections.OrderedDict.fromkeys(
+            account_id for account_id, _ in campaigns):
+        rollups.flush(account_id, complete=complete[account_id])
 
-    account_ids_to_iterate = list(config.get('account_ids', [marketer['id'] for marketer in marketers]))
-    LOGGER.info(f"Iterating {len(account_ids_to_iterate)} marketer accounts ({account_ids_to_iterate})")
 
-    # Iterate over all these customer accounts
-    for account_id in account_ids_to_iterate:
-        LOGGER.info(f"Iterating {account_id}")
-        sync_campaigns(state, access_token, account_id)
+@utils.handle_top_exception(LOGGER)
+def resync_main():
+    """
+    Entry point of `tap-outbrain-resync`, i.e.
+
+        tap-outbrain-resync -c config.json --marketer M1 --campaign C1
+            --campaign C2 --from 2023-01-01 --to 2023-01-31
+    """
+    parser = argparse.ArgumentParser(
+        description='Re-emit report streams of selected campaigns for a '
+                    'date range without touching bookmarks.')
+    parser.add_argument('-c', '--config', required=True, help='Config file')
+    parser.add_argument('--marketer', action='append', required=True,
+                        help='Marketer ID, can be repeated')
+    parser.add_argument('--campaign', action='append', default=[],
+                        help='Campaign ID, can be repeated. Defaults to all '
+                             'campaigns of the marketers.')
+    parser.add_argument('--from', dest='from_date', required=True,
+                        type=datetime.date.fromisoformat,
+                        help='First day to resync, i.e. 2023-01-01')
+    parser.add_argument('--to', dest='to_date', default=datetime.date.today(),
+                        type=datetime.date.fromisoformat,
+                        help='Last day to resync, defaults to today')
+    parser.add_argument('--workers', type=int, default=RESYNC_DEFAULT_WORKERS,
+                        help='Windows fetched in parallel')
+    args = parser.parse_args()
+
+    if args.from_date > args.to_date:
+        parser.error('--from must not be after --to')
+
+    resync(utils.load_json(args.config), args.marketer, args.campaign,
+           args.from_date, args.to_date, args.workers)
+
+
+def parse_profile_arg():
+    """
+    Strip the tap specific `--profile [PATH]` flag from `sys.argv` before
+    handing the rest to `singer.utils.parse_args`, which rejects unknown
+    arguments. Returns the report path, or `None` when not profiling.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--profile', nargs='?', const=profiling.DEFAULT_REPORT_PATH)
+    args, remaining = parser.parse_known_args()
+    sys.argv = sys.argv[:1] + remaining
+    return args.profile
+
 
 @utils.handle_top_exception(LOGGER)
 def main():
+    profile_path = parse_profile_arg()
+    if profile_path:
+        profiling.start(profile_path)
+    try:
+        run()
+    finally:
+        profiling.stop()
+
+
+def run():
     # Parse command line arguments
     args = utils.parse_args(REQUIRED_CONFIG_KEYS)
 
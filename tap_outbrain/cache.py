@@ -0,0 +1,104 @@
+"""
+Entity cache for slowly changing endpoints (marketers, campaigns), enabled
+with the `entity_cache_path` config key.
+
+Every cached response keeps its ETag/Last-Modified validators, a sha256 of
+the raw payload and the decoded body. Requests send the validators as
+conditional headers; when the API answers 304, or returns a payload with
+the same hash, the cached body is reused instead of decoding it again.
+"""
+
+import json
+import os
+
+import singer
+
+LOGGER = singer.get_logger()
+
+ENABLED = False
+PATH = None
+ENTRIES = {}
+HITS = 0
+MISSES = 0
+
+_DIRTY = False
+
+
+def load(path):
+    # pylint: disable=global-statement
+    global ENABLED, PATH, ENTRIES
+    ENABLED = True
+    PATH = path
+    ENTRIES = {}
+
+    if os.path.exists(path):
+        try:
+            with open(path) as file:
+                ENTRIES = json.load(file)
+        except ValueError:
+            LOGGER.warning('Ignoring unreadable entity cache `{}`'.format(path))
+
+    LOGGER.info('Loaded {} entity cache entries from `{}`'.format(
+        len(ENTRIES), path))
+
+
+def save():
+    # pylint: disable=global-statement
+    global _DIRTY
+    if not ENABLED or not _DIRTY:
+        return
+
+    # Write to a temporary file first so a crash can't leave a truncated
+    # cache behind.
+    tmp_path = PATH + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(ENTRIES, file)
+    os.replace(tmp_path, PATH)
+    _DIRTY = False
+
+    LOGGER.info('Saved {} entity cache entries to `{}` ({} hits, {} misses)'
+                .format(len(ENTRIES), PATH, HITS, MISSES))
+
+
+def cache_key(url, params=None):
+    return '{}?{}'.format(url, json.dumps(params or {}, sort_keys=True,
+                                          default=str))
+
+
+def lookup(key):
+    if not ENABLED:
+        return None
+    return ENTRIES.get(key)
+
+
+def conditional_headers(entry):
+    headers = {}
+    if entry is None:
+        return headers
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def hit(entry):
+    # pylint: disable=global-statement
+    global HITS
+    HITS += 1
+    return entry['body']
+
+
+def store(key, response_headers, content_hash, body):
+    # pylint: disable=global-statement
+    global MISSES, _DIRTY
+    MISSES += 1
+    if not ENABLED:
+        return
+    ENTRIES[key] = {
+        'etag': response_headers.get('ETag'),
+        'last_modified': response_headers.get('Last-Modified'),
+        'hash': content_hash,
+        'body': body,
+    }
+    _DIRTY = True
@@ -0,0 +1,235 @@
+"""
+Opt-in compact encoding for the tap's stdout, enabled with
+`"output_encoding": "gzip"` in the config.
+
+Singer messages are buffered and written as a series of complete gzip
+members ("frames"). A frame is cut every `FRAME_BYTES` of JSON, right
+after every STATE message, and at the latest `FRAME_SECONDS` after its
+first message, even if the tap goes quiet (i.e. while sleeping for the
+rate limit). Targets therefore see state messages as soon as they are
+written. Concatenated gzip members form a valid gzip stream,
+so `gunzip` restores the plain singer JSON lines; `tap-outbrain-decode`
+does the same without depending on gzip tooling:
+
+    tap-outbrain -c config.json | ssh target-host 'tap-outbrain-decode | target-foo'
+
+Run `python -m tap_outbrain.encoding bench [RECORDS] [ROWS_PER_STATE]` to
+compare against plain JSON. The benchmark encodes synthetic, highly
+repetitive records, so real output compresses less well than it reports.
+"""
+
+import atexit
+import gzip
+import io
+import json
+import math
+import sys
+import threading
+import time
+import zlib
+
+import singer
+
+LOGGER = singer.get_logger()
+
+ENCODINGS = ('json', 'gzip')
+FRAME_BYTES = 256 * 1024
+FRAME_SECONDS = 2.0
+COMPRESSION_LEVEL = 6
+# `singer.format_message` always writes the message type first
+STATE_PREFIX = '{"type": "STATE"'
+
+
+class GzipFrameWriter:
+    """
+    File-like replacement for `sys.stdout`. `flush()` is called by singer
+    after every message, so it only cuts a frame once it is due. A timer
+    cuts frames that become due while nothing is written.
+    """
+
+    def __init__(self, raw, frame_bytes=FRAME_BYTES,
+                 frame_seconds=FRAME_SECONDS, level=COMPRESSION_LEVEL):
+        self.raw = raw
+        self.frame_bytes = frame_bytes
+        self.frame_seconds = frame_seconds
+        self.level = level
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._buffer = []
+        self._buffered = 0
+        self._frame_start = time.time()
+        self._frames = 0
+        self._timer = None
+        # The idle timer writes frames from its own thread
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        with self._lock:
+            if not self._buffer:
+                self._frame_start = time.time()
+                self._start_timer()
+            self._buffer.append(data)
+            self._buffered += len(data)
+            if self._buffered >= self.frame_bytes or text.startswith(STATE_PREFIX):
+                self._write_frame()
+        return len(text)
+
+    def flush(self):
+        with self._lock:
+            if self._buffer and time.time() - self._frame_start >= self.frame_seconds:
+                self._write_frame()
+
+    def close(self):
+        with self._lock:
+            if self._buffer:
+                self._write_frame()
+        if self.bytes_in:
+            LOGGER.info('gzip output: {} bytes of JSON sent as {} bytes ({:.1%})'
+                        .format(self.bytes_in, self.bytes_out,
+                                self.bytes_out / self.bytes_in))
+
+    def _start_timer(self):
+        if not math.isfinite(self.frame_seconds):
+            return
+        self._timer = threading.Timer(self.frame_seconds, self._on_timer,
+                                      args=(self._frames,))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self, frame):
+        with self._lock:
+            # The frame the timer was started for may already be written
+            if frame == self._frames and self._buffer:
+                self._write_frame()
+
+    def _write_frame(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        payload = b''.join(self._buffer)
+        frame = gzip.compress(payload, compresslevel=self.level)
+        self.raw.write(frame)
+        self.raw.flush()
+        self.bytes_in += len(payload)
+        self.bytes_out += len(frame)
+        self._buffer = []
+        self._buffered = 0
+        self._frames += 1
+
+
+def enable(output_encoding):
+    if output_encoding not in ENCODINGS:
+        LOGGER.fatal('Unknown output_encoding `{}`, expected one of {}.'.format(
+            output_encoding, ', '.join(ENCODINGS)))
+        raise RuntimeError
+    if output_encoding == 'json' or isinstance(sys.stdout, GzipFrameWriter):
+        return
+
+    sys.stdout.flush()
+    writer = GzipFrameWriter(sys.stdout.buffer)
+    sys.stdout = writer
+    atexit.register(writer.close)
+
+
+def decode(in_stream, out_stream, chunk_size=64 * 1024):
+    """
+    Decode a stream of gzip frames from `in_stream` into plain JSON lines on
+    `out_stream` (both binary), incrementally.
+    """
+    decompressor = zlib.decompressobj(wbits=31)
+    while True:
+        chunk = in_stream.read1(chunk_size) if hasattr(in_stream, 'read1') \
+            else in_stream.read(chunk_size)
+        if not chunk:
+            break
+        while chunk:
+            out_stream.write(decompressor.decompress(chunk))
+            if not decompressor.eof:
+                break
+            # Start of the next frame
+            chunk = decompressor.unused_data
+            decompressor = zlib.decompressobj(wbits=31)
+        out_stream.flush()
+
+
+def decode_main():
+    decode(sys.stdin.buffer, sys.stdout.buffer)
+
+
+def _sample_messages(count, rows_per_state):
+    for i in range(count):
+        if i and i % rows_per_state == 0:
+            # The tap writes state after every report window
+            yield singer.StateMessage(value={'campaign_performance': {
+                '00f4b02153ee75f3c9dc4fc128ab0{:05d}'.format(i // 30):
+                    '2022-{:02d}-{:02d}'.format(i % 12 + 1, i % 28 + 1)}})
+        yield singer.RecordMessage(
+            stream='campaign_performance',
+            record={
+                'campaignId': '00f4b02153ee75f3c9dc4fc128ab0{:05d}'.format(i // 30),
+                'campaignName': 'Campaign {}'.format(i // 30),
+                'fromDate': '2022-{:02d}-{:02d}'.format(i % 12 + 1, i % 28 + 1),
+                'impressions': 1000 + i % 997,
+                'clicks': 10 + i % 89,
+                'ctr': round((10 + i % 89) / (1000 + i % 997) * 100, 4),
+                'spend': round((10 + i % 89) * 0.37, 2),
+                'ecpc': 0.37,
+                'conversions': i % 7,
+                'conversionRate': round(i % 7 / (10 + i % 89) * 100, 4),
+                'cpa': round((10 + i % 89) * 0.37 / max(i % 7, 1), 2),
+            },
+            time_extracted=singer.utils.now())
+
+
+def bench(count=100000, rows_per_state=3):
+    """
+    Encode `count` synthetic `campaign_performance` records, with a STATE
+    message every `rows_per_state` records, as plain singer JSON and as gzip
+    frames, then report size and encoding time per record.
+
+    An incremental run syncs ~3 days per report window, hence the default.
+    Full backfills write up to 100 rows per window and compress better.
+    """
+    lines = [singer.format_message(message) + '\n'
+             for message in _sample_messages(count, rows_per_state)]
+
+    start = time.perf_counter()
+    plain = io.BytesIO()
+    for line in lines:
+        plain.write(line.encode('utf-8'))
+    plain_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compressed = io.BytesIO()
+    writer = GzipFrameWriter(compressed, frame_seconds=float('inf'))
+    for line in lines:
+        writer.write(line)
+        writer.flush()
+    writer.close()
+    gzip_seconds = time.perf_counter() - start
+
+    decoded = io.BytesIO()
+    compressed.seek(0)
+    decode(compressed, decoded)
+    assert decoded.getvalue() == plain.getvalue()
+
+    results = {
+        'records': count,
+        'rows_per_state': rows_per_state,
+        'json_bytes_per_record': plain.tell() / count,
+        'gzip_bytes_per_record': compressed.tell() / count,
+        'ratio': compressed.tell() / plain.tell(),
+        'json_usec_per_record': plain_seconds / count * 1e6,
+        'gzip_usec_per_record': gzip_seconds / count * 1e6,
+    }
+    print(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 100000,
+              int(sys.argv[3]) if len(sys.argv) > 3 else 3)
+    else:
+        decode_main()
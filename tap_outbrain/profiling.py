@@ -0,0 +1,154 @@
+"""
+Opt-in profiling for tap runs, enabled with `--profile [PATH]`.
+
+Records wall and (per thread) CPU time per named stage and samples the main thread's
+stack to produce a flamegraph-compatible (collapsed stack) dump. When
+profiling is disabled `stage()` returns a shared no-op context manager so
+the instrumented hot paths pay next to nothing.
+"""
+
+import collections
+import os
+import sys
+import threading
+import time
+
+import singer
+
+LOGGER = singer.get_logger()
+
+DEFAULT_REPORT_PATH = 'tap-outbrain-profile.txt'
+SAMPLE_INTERVAL_SECONDS = 0.01
+
+ENABLED = False
+REPORT_PATH = None
+STAGES = collections.defaultdict(lambda: {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+STACKS = collections.Counter()
+
+_RUN_START = None
+_SAMPLER = None
+_SAMPLER_STOP = threading.Event()
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ('name', 'wall_start', 'cpu_start')
+
+    def __init__(self, name):
+        self.name = name
+        self.wall_start = None
+        self.cpu_start = None
+
+    def __enter__(self):
+        self.wall_start = time.perf_counter()
+        # CPU of this thread only, so the sampler thread's own work isn't
+        # charged to whichever stage is open.
+        self.cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        totals = STAGES[self.name]
+        totals['calls'] += 1
+        totals['wall'] += time.perf_counter() - self.wall_start
+        totals['cpu'] += time.thread_time() - self.cpu_start
+        return False
+
+
+def stage(name):
+    """
+    Context manager timing the enclosed block under `name`, i.e.
+
+        with profiling.stage('request'):
+            resp = SESSION.send(req)
+    """
+    if not ENABLED:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+def _sample(thread_id):
+    while not _SAMPLER_STOP.wait(SAMPLE_INTERVAL_SECONDS):
+        frame = sys._current_frames().get(thread_id)  # pylint: disable=protected-access
+        stack = []
+        while frame is not None:
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+        if stack:
+            STACKS[';'.join(reversed(stack))] += 1
+
+
+def start(report_path=None):
+    # pylint: disable=global-statement
+    global ENABLED, REPORT_PATH, _RUN_START, _SAMPLER
+    ENABLED = True
+    REPORT_PATH = report_path or DEFAULT_REPORT_PATH
+    _RUN_START = (time.perf_counter(), time.process_time())
+
+    _SAMPLER_STOP.clear()
+    _SAMPLER = threading.Thread(target=_sample,
+                                args=(threading.get_ident(),),
+                                name='tap-outbrain-profiler',
+                                daemon=True)
+    _SAMPLER.start()
+    LOGGER.info('Profiling enabled, report will be written to `{}`'.format(
+        REPORT_PATH))
+
+
+def stop():
+    """
+    Stop sampling and write the report. The stage breakdown goes to
+    `REPORT_PATH`, the collapsed stacks to `REPORT_PATH + '.folded'`, which
+    can be fed straight to `flamegraph.pl` or speedscope.
+    """
+    # pylint: disable=global-statement
+    global ENABLED
+    if not ENABLED:
+        return
+    ENABLED = False
+
+    _SAMPLER_STOP.set()
+    _SAMPLER.join()
+
+    total_wall = time.perf_counter() - _RUN_START[0]
+    total_cpu = time.process_time() - _RUN_START[1]
+
+    lines = [
+        'tap-outbrain profile',
+        'total wall {:.3f} sec, total cpu {:.3f} sec'.format(total_wall, total_cpu),
+        '',
+        '{:<24} {:>10} {:>12} {:>12} {:>8}'.format(
+            'stage', 'calls', 'wall sec', 'cpu sec', 'wall %'),
+    ]
+    for name, totals in sorted(STAGES.items(),
+                               key=lambda item: item[1]['wall'],
+                               reverse=True):
+        lines.append('{:<24} {:>10} {:>12.3f} {:>12.3f} {:>7.1f}%'.format(
+            name, totals['calls'], totals['wall'], totals['cpu'],
+            100.0 * totals['wall'] / total_wall if total_wall else 0.0))
+
+    with open(REPORT_PATH, 'w') as report:
+        report.write('\n'.join(lines) + '\n')
+
+    with open(REPORT_PATH + '.folded', 'w') as folded:
+        for stack, count in STACKS.most_common():
+            folded.write('{} {}\n'.format(stack, count))
+
+    LOGGER.info('Profile written to `{}` and `{}.folded`'.format(
+        REPORT_PATH, REPORT_PATH))
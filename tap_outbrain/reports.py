@@ -0,0 +1,142 @@
+"""
+Declarative definitions of the report streams synced for every campaign.
+
+Each definition only describes a report; windowing, pagination, rate
+limiting, bookmarking and emitting are shared by all of them (see
+`sync_report_streams`). Adding a periodic breakdown is a matter of adding a
+`ReportStream` here and its schema to `schemas.py`.
+"""
+
+import collections
+
+import tap_outbrain.schemas as schemas
+
+ReportStream = collections.namedtuple('ReportStream', [
+    # Stream name, also the key of its bookmarks in the state
+    'name',
+    # Report endpoint relative to BASE_URL, formatted with `account_id`
+    'path',
+    # Value of the `breakdown` query parameter. Must be a periodic
+    # breakdown (i.e. `daily`), every row needs a `fromDate`.
+    'breakdown',
+    # Result `metadata` fields copied onto every record. Must include
+    # `fromDate`, which is used as the bookmark.
+    'dimensions',
+    'key_properties',
+    'schema',
+    # Additional query parameters sent with every request
+    'params',
+    # What one request covers, see `SCOPES`
+    'scope',
+    # Key of the result list in the response
+    'results_key',
+    # For responses nesting results per entity (i.e. per campaign), maps
+    # the entity `metadata` fields onto result `metadata` fields. `None`
+    # for flat responses.
+    'entity_fields',
+    # Whether the daily rows of campaign scoped requests feed the rollups
+    # (see `rollups.py`). Their bookmarks are then aligned to the start of
+    # the rollup periods.
+    'feeds_rollups',
+])
+
+# scope -> query parameter selecting the scope ID, `None` when the report
+# endpoint is already scoped by the marketer ID in its path.
+SCOPES = {
+    'campaign': 'campaignId',
+    'marketer': None,
+}
+
+CAMPAIGN_PERFORMANCE = ReportStream(
+    name='campaign_performance',
+    path='reports/marketers/{account_id}/periodic',
+    breakdown='daily',
+    dimensions=('fromDate',),
+    key_properties=['campaignId', 'fromDate'],
+    schema=schemas.campaign_performance,
+    params={'sort': '+fromDate', 'includeArchivedCampaigns': True},
+    scope='campaign',
+    results_key='results',
+    entity_fields=None,
+    feeds_rollups=True,
+)
+
+# The same rows as `CAMPAIGN_PERFORMANCE` for every campaign of a marketer
+# in a single request, paginated by campaign.
+CAMPAIGN_PERFORMANCE_BY_MARKETER = CAMPAIGN_PERFORMANCE._replace(
+    path='reports/marketers/{account_id}/campaigns/periodic',
+    dimensions=('fromDate', 'campaignId', 'campaignName'),
+    params={'includeArchivedCampaigns': True},
+    scope='marketer',
+    results_key='campaignResults',
+    entity_fields={'id': 'campaignId', 'name': 'campaignName'},
+    feeds_rollups=False,
+)
+
+REPORT_STREAMS = {stream.name: stream for stream in [
+    CAMPAIGN_PERFORMANCE,
+]}
+
+# Marketer scoped equivalents of campaign scoped report streams, used by
+# watch mode to poll all campaigns of a marketer at once.
+MARKETER_REPORT_STREAMS = {
+    'campaign_performance': CAMPAIGN_PERFORMANCE_BY_MARKETER,
+}
+
+DEFAULT_REPORT_STREAMS = ['campaign_performance']
+
+
+def validate(stream):
+    """
+    Check the assumptions the shared pipeline makes about a definition.
+    """
+    if stream.breakdown is None or 'fromDate' not in stream.dimensions:
+        raise ValueError('Report stream `{}` needs a periodic breakdown and a '
+                         '`fromDate` dimension'.format(stream.name))
+    if stream.scope not in SCOPES:
+        raise ValueError('Report stream `{}` has unknown scope `{}`'.format(
+            stream.name, stream.scope))
+    if stream.feeds_rollups and stream.scope != 'campaign':
+        raise ValueError('Report stream `{}` can only feed rollups with '
+                         'campaign scope'.format(stream.name))
+
+
+for _stream in list(REPORT_STREAMS.values()) + list(MARKETER_REPORT_STREAMS.values()):
+    validate(_stream)
+
+
+def request_key(stream):
+    """
+    Streams with the same request key share a single request per window.
+    """
+    return (stream.path, stream.breakdown, stream.scope,
+            tuple(sorted(stream.params.items())))
+
+
+def flatten_results(stream, page):
+    """
+    Turn one page of a response into flat results, copying the entity
+    fields of nested responses into the `metadata` of each result.
+    """
+    if stream.entity_fields is None:
+        return page
+
+    results = []
+    for entity in page:
+        entity_metadata = entity.get('metadata', {})
+        for result in entity.get('results', []):
+            metadata = dict(result.get('metadata', {}))
+            for entity_field, field in stream.entity_fields.items():
+                metadata[field] = entity_metadata.get(entity_field)
+            results.append({**result, 'metadata': metadata})
+    return results
+
+
+def scope_params(stream, scope_id):
+    """
+    Query parameters restricting a request of `stream` to `scope_id`.
+    """
+    param = SCOPES[stream.scope]
+    if param is None:
+        return {}
+    return {param: scope_id}
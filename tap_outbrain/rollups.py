@@ -0,0 +1,282 @@
+"""
+Optional weekly/monthly rollups of `campaign_performance`, enabled with the
+`rollups` config key (a list of stream names from `ROLLUP_STREAMS`).
+
+Daily rows are buffered column-wise per account as each report window
+completes and aggregated with NumPy in one pass per rollup stream when the
+account is done. Only periods that were fully fetched in this sync are emitted, so a
+partial period never overwrites a complete one downstream. To make the
+touched periods complete, `align_start` moves the start of every
+performance fetch back to the start of the enclosing period, up to ~37
+days (the Monday before the 1st of the month when both weekly and monthly
+rollups are enabled). The extra days only reach the rollups, daily rows
+before the bookmark are not emitted again. A backfill occasionally needs
+one extra report request, when the longer range no longer fits into a
+single 100 day window.
+
+A period cut off by the end of a run (e.g. `DeadlineReached`) is dropped
+and recomputed by the next run, which aligns its start to that period.
+
+Marketer rollups span every campaign of an account, so a period is only
+emitted once every campaign synced in full and all of them covered it.
+"""
+
+import datetime
+
+import singer
+
+LOGGER = singer.get_logger()
+
+# stream name -> (grouping, period)
+ROLLUP_STREAMS = {
+    'campaign_performance_weekly': ('campaign', 'weekly'),
+    'campaign_performance_monthly': ('campaign', 'monthly'),
+    'marketer_performance_weekly': ('marketer', 'weekly'),
+    'marketer_performance_monthly': ('marketer', 'monthly'),
+}
+METRICS = ('impressions', 'clicks', 'spend', 'conversions')
+
+ENABLED = False
+STREAMS = []
+
+np = None  # pylint: disable=invalid-name
+
+# account ID -> buffered rows, see `_new_buffer`. Accounts are buffered
+# separately as campaigns of several accounts are synced interleaved.
+_BUFFERS = {}
+
+
+def enable(stream_names):
+    # pylint: disable=global-statement
+    global ENABLED, STREAMS, np
+    unknown = set(stream_names) - set(ROLLUP_STREAMS)
+    if unknown:
+        LOGGER.fatal('Unknown rollup streams {}, expected some of {}.'.format(
+            sorted(unknown), sorted(ROLLUP_STREAMS)))
+        raise RuntimeError
+
+    try:
+        import numpy  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        LOGGER.fatal('Rollups require numpy, install tap-outbrain[rollups].')
+        raise
+
+    np = numpy
+    ENABLED = bool(stream_names)
+    STREAMS = list(stream_names)
+
+
+def disable_marketer_rollups(reason):
+    # pylint: disable=global-statement
+    global STREAMS
+    dropped = [name for name in STREAMS if ROLLUP_STREAMS[name][0] == 'marketer']
+    if dropped:
+        LOGGER.warning('Not emitting {}: {}'.format(dropped, reason))
+        STREAMS = [name for name in STREAMS if name not in dropped]
+
+
+def key_properties(stream_name):
+    if ROLLUP_STREAMS[stream_name][0] == 'campaign':
+        return ['campaignId', 'periodStart']
+    return ['marketerId', 'periodStart']
+
+
+def week_start(date):
+    return date - datetime.timedelta(days=date.weekday())
+
+
+def month_start(date):
+    return date.replace(day=1)
+
+
+def align_start(date):
+    """
+    Move `date` back so every enabled period containing it starts on or
+    after the returned date. With both weekly and monthly rollups that is
+    the Monday of the week containing the 1st of the month, so the week
+    straddling the month start is complete as well.
+    """
+    if not ENABLED:
+        return date
+    periods = {ROLLUP_STREAMS[name][1] for name in STREAMS}
+    aligned = date
+    if 'monthly' in periods:
+        aligned = month_start(aligned)
+    if 'weekly' in periods:
+        aligned = week_start(aligned)
+    return aligned
+
+
+def week_end(date):
+    return week_start(date) + datetime.timedelta(days=6)
+
+
+def month_end(date):
+    return (month_start(date) + datetime.timedelta(days=32)).replace(day=1) \
+        - datetime.timedelta(days=1)
+
+
+def align_end(date):
+    """
+    Counterpart of `align_start`: move `date` forward to the end of every
+    enabled period containing it, but not past today.
+    """
+    if not ENABLED:
+        return date
+    periods = {ROLLUP_STREAMS[name][1] for name in STREAMS}
+    aligned = date
+    if 'monthly' in periods:
+        aligned = month_end(aligned)
+    if 'weekly' in periods:
+        aligned = week_end(aligned)
+    return min(aligned, datetime.date.today())
+
+
+def _new_buffer():
+    return {
+        'campaign_ids': [],
+        'dates': [],
+        'metrics': {metric: [] for metric in METRICS},
+        'campaign_names': {},
+        # campaign ID -> [first day, last day] fetched for it in this sync.
+        # The last day is `datetime.date.max` once the window ending today
+        # completed, the current period is then as complete as it can be.
+        'coverage': {},
+    }
+
+
+def add_rows(account_id, campaign_id, from_date, to_date, records):
+    """
+    Buffer the daily rows of one completed report window of a campaign.
+    Windows must be added in date order.
+    """
+    if not ENABLED:
+        return
+    buffer = _BUFFERS.setdefault(account_id, _new_buffer())
+    if to_date >= datetime.date.today():
+        to_date = datetime.date.max
+    if campaign_id in buffer['coverage']:
+        buffer['coverage'][campaign_id][1] = to_date
+    else:
+        buffer['coverage'][campaign_id] = [from_date, to_date]
+    for record in records:
+        buffer['campaign_ids'].append(campaign_id)
+        buffer['dates'].append(record['fromDate'])
+        for metric in METRICS:
+            buffer['metrics'][metric].append(record.get(metric, 0))
+        if record.get('campaignName') is not None:
+            buffer['campaign_names'][campaign_id] = record['campaignName']
+
+
+def _period_starts(dates, period):
+    if period == 'monthly':
+        return dates.astype('datetime64[M]').astype('datetime64[D]')
+    # 1970-01-01 was a Thursday, shift so that weeks start on Monday.
+    days = dates.astype('int64')
+    return (days - (days + 3) % 7).astype('datetime64[D]')
+
+
+def _period_end(period_start, period):
+    if period == 'monthly':
+        return (period_start.astype('datetime64[M]') + 1).astype('datetime64[D]') - 1
+    return period_start + 6
+
+
+def _ratio(numerator, denominator, scale=1.0):
+    out = np.zeros_like(numerator, dtype='float64')
+    np.divide(numerator * scale, denominator, out=out, where=denominator != 0)
+    return out
+
+
+def _aggregate(group_codes, period_starts, columns):
+    """
+    Sum `columns` per (group, period). Returns the unique group codes,
+    period starts, day counts and summed columns.
+    """
+    period_values, period_codes = np.unique(period_starts, return_inverse=True)
+    combined = group_codes * len(period_values) + period_codes
+    keys, inverse = np.unique(combined, return_inverse=True)
+    sums = {metric: np.bincount(inverse, weights=column, minlength=len(keys))
+            for metric, column in columns.items()}
+    days = np.bincount(inverse, minlength=len(keys))
+    return (keys // len(period_values), period_values[keys % len(period_values)],
+            days, sums)
+
+
+def flush(account_id, complete=True):
+    """
+    Aggregate and emit the buffered rows of `account_id`, then drop the
+    buffer. Marketer rollups are skipped unless the whole account synced
+    (`complete`).
+    """
+    buffer = _BUFFERS.pop(account_id, None)
+    if not ENABLED or buffer is None or not buffer['dates']:
+        return
+
+    coverage = buffer['coverage']
+    campaign_values, campaign_codes = np.unique(
+        np.array(buffer['campaign_ids']), return_inverse=True)
+    dates = np.array(buffer['dates'], dtype='datetime64[D]')
+    columns = {metric: np.array(values, dtype='float64')
+               for metric, values in buffer['metrics'].items()}
+    coverage_starts = np.array([coverage[campaign_id][0] for campaign_id in campaign_values],
+                               dtype='datetime64[D]')
+    coverage_ends = np.array([coverage[campaign_id][1] for campaign_id in campaign_values],
+                             dtype='datetime64[D]')
+    time_extracted = singer.utils.now()
+
+    for stream_name in STREAMS:
+        grouping, period = ROLLUP_STREAMS[stream_name]
+        if grouping == 'marketer' and not complete:
+            LOGGER.info('Skipping {} for {}, not every campaign synced'.format(
+                stream_name, account_id))
+            continue
+
+        if grouping == 'campaign':
+            group_codes = campaign_codes
+        else:
+            group_codes = np.zeros(len(dates), dtype='int64')
+
+        groups, starts, days, sums = _aggregate(
+            group_codes, _period_starts(dates, period), columns)
+        ends = _period_end(starts, period)
+
+        # Only periods every contributing campaign fetched in full
+        if grouping == 'campaign':
+            covered = (starts >= coverage_starts[groups]) & (ends <= coverage_ends[groups])
+        else:
+            covered = (starts >= coverage_starts.max()) & (ends <= coverage_ends.min())
+
+        ctr = _ratio(sums['clicks'], sums['impressions'], 100.0)
+        ecpc = _ratio(sums['spend'], sums['clicks'])
+        cpa = _ratio(sums['spend'], sums['conversions'])
+        conversion_rate = _ratio(sums['conversions'], sums['clicks'], 100.0)
+
+        emitted = 0
+        for i in range(len(starts)):
+            if not covered[i]:
+                continue
+            record = {
+                'marketerId': str(account_id),
+                'periodStart': str(starts[i]),
+                'periodEnd': str(ends[i]),
+                'days': int(days[i]),
+                'impressions': int(sums['impressions'][i]),
+                'clicks': int(sums['clicks'][i]),
+                'spend': float(sums['spend'][i]),
+                'conversions': int(sums['conversions'][i]),
+                'ctr': float(ctr[i]),
+                'ecpc': float(ecpc[i]),
+                'cpa': float(cpa[i]),
+                'conversionRate': float(conversion_rate[i]),
+            }
+            if grouping == 'campaign':
+                campaign_id = str(campaign_values[groups[i]])
+                record['campaignId'] = campaign_id
+                if campaign_id in buffer['campaign_names']:
+                    record['campaignName'] = buffer['campaign_names'][campaign_id]
+            singer.write_record(stream_name, record, time_extracted=time_extracted)
+            emitted += 1
+
+        LOGGER.info('Emitted {} {} rows for {}'.format(
+            emitted, stream_name, account_id))
@@ -273,6 +273,91 @@ campaign_performance = {
     }
 }
 
+_rollup_metrics = {
+    'periodStart': {
+        'type': 'string',
+        'format': 'date',
+        'description': ('The first day of the rollup period (Monday for '
+                        'weekly, the 1st for monthly rollups).')
+    },
+    'periodEnd': {
+        'type': 'string',
+        'format': 'date',
+        'description': 'The last calendar day of the rollup period.'
+    },
+    'days': {
+        'type': 'integer',
+        'description': ('Number of daily `campaign_performance` rows '
+                        'aggregated into this record.')
+    },
+    'impressions': {
+        'type': 'number',
+        'description': 'Total PromotedLinks impressions in the period.',
+    },
+    'clicks': {
+        'type': 'number',
+        'description': 'Total PromotedLinks clicks in the period.',
+    },
+    'spend': {
+        'type': 'number',
+        'description': 'Total amount of money spent in the period.',
+    },
+    'conversions': {
+        'type': 'number',
+        'description': 'Total number of conversions in the period.',
+    },
+    'ctr': {
+        'type': 'number',
+        'description': ('CTR (Click Through Rate) percentage over the '
+                        'period. Calculated as: (clicks / impressions) * 100'),
+    },
+    'ecpc': {
+        'type': 'number',
+        'description': ('Effective CPC (Cost Per Click) over the period. '
+                        'Calculated as: (spend / clicks)'),
+    },
+    'cpa': {
+        'type': 'number',
+        'description': ('CPA (Cost Per Acquisition) over the period. '
+                        'Calculated as: (spend / conversions)')
+    },
+    'conversionRate': {
+        'type': 'number',
+        'description': ('Conversions per click percentage over the period. '
+                        'Calculated as: (conversions / clicks) * 100')
+    },
+}
+
+campaign_performance_rollup = {
+    'type': 'object',
+    'properties': {
+        'campaignId': {
+            'type': 'string',
+            'description': 'The campaign ID for this record.'
+        },
+        'campaignName': {
+            'type': 'string',
+            'description': 'The (current) campaign name for this record.'
+        },
+        'marketerId': {
+            'type': 'string',
+            'description': 'The marketer ID the campaign belongs to.'
+        },
+        **_rollup_metrics,
+    }
+}
+
+marketer_performance_rollup = {
+    'type': 'object',
+    'properties': {
+        'marketerId': {
+            'type': 'string',
+            'description': 'The marketer ID for this record.'
+        },
+        **_rollup_metrics,
+    }
+}
+
 link_performance = {
     'type': 'object',
     'properties': {
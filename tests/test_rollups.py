@@ -0,0 +1,198 @@
+import datetime
+import unittest
+from unittest import mock
+
+import tap_outbrain.rollups as rollups
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+@unittest.skipIf(np is None, 'rollups require numpy')
+class TestRollups(unittest.TestCase):
+
+    def tearDown(self):
+        rollups.ENABLED = False
+        rollups.STREAMS = []
+        rollups._BUFFERS.clear()
+
+    @staticmethod
+    def _days(start, count, clicks=1):
+        return [{'fromDate': (start + datetime.timedelta(days=i)).isoformat(),
+                 'clicks': clicks, 'impressions': 10 * clicks}
+                for i in range(count)]
+
+    @staticmethod
+    def _flush(account_id, complete=True):
+        with mock.patch('tap_outbrain.rollups.singer.write_record') as write_record:
+            rollups.flush(account_id, complete=complete)
+        return [(call.args[0], call.args[1]) for call in write_record.call_args_list]
+
+    def test_align_start_weekly(self):
+        rollups.enable(['campaign_performance_weekly'])
+        # Wednesday -> Monday of the same week
+        self.assertEqual(rollups.align_start(datetime.date(2023, 3, 15)),
+                         datetime.date(2023, 3, 13))
+
+    def test_align_start_monthly(self):
+        rollups.enable(['campaign_performance_monthly'])
+        self.assertEqual(rollups.align_start(datetime.date(2023, 3, 15)),
+                         datetime.date(2023, 3, 1))
+
+    def test_align_start_weekly_and_monthly(self):
+        rollups.enable(['campaign_performance_weekly',
+                        'campaign_performance_monthly'])
+        # 2023-03-01 is a Wednesday, the week containing it starts on the
+        # Monday before.
+        aligned = rollups.align_start(datetime.date(2023, 3, 15))
+        self.assertEqual(aligned, datetime.date(2023, 2, 27))
+        self.assertEqual(aligned.weekday(), 0)
+
+    def test_align_end_weekly_and_monthly(self):
+        rollups.enable(['campaign_performance_weekly',
+                        'campaign_performance_monthly'])
+        # 2023-03-31 is a Friday, the week containing it ends on Sunday.
+        self.assertEqual(rollups.align_end(datetime.date(2023, 3, 15)),
+                         datetime.date(2023, 4, 2))
+
+    def test_align_end_not_past_today(self):
+        rollups.enable(['campaign_performance_monthly'])
+        today = datetime.date.today()
+        self.assertEqual(rollups.align_end(today), today)
+
+    def test_align_start_disabled(self):
+        self.assertEqual(rollups.align_start(datetime.date(2023, 3, 15)),
+                         datetime.date(2023, 3, 15))
+
+    def test_aggregate(self):
+        rollups.enable(['campaign_performance_weekly'])
+        dates = np.array(['2023-02-27', '2023-03-01', '2023-03-06', '2023-03-01'],
+                         dtype='datetime64[D]')
+        group_codes = np.array([0, 0, 0, 1])
+        columns = {'clicks': np.array([1.0, 2.0, 4.0, 8.0])}
+
+        groups, starts, days, sums = rollups._aggregate(
+            group_codes, rollups._period_starts(dates, 'weekly'), columns)
+
+        self.assertEqual(groups.tolist(), [0, 0, 1])
+        self.assertEqual([str(start) for start in starts],
+                         ['2023-02-27', '2023-03-06', '2023-02-27'])
+        self.assertEqual(days.tolist(), [2, 1, 1])
+        self.assertEqual(sums['clicks'].tolist(), [3.0, 4.0, 8.0])
+
+    def test_aggregate_monthly_period_end(self):
+        rollups.enable(['campaign_performance_monthly'])
+        dates = np.array(['2024-02-03', '2024-02-29'], dtype='datetime64[D]')
+        _, starts, days, _ = rollups._aggregate(
+            np.zeros(2, dtype='int64'), rollups._period_starts(dates, 'monthly'),
+            {'clicks': np.array([1.0, 1.0])})
+
+        self.assertEqual([str(start) for start in starts], ['2024-02-01'])
+        self.assertEqual(str(rollups._period_end(starts, 'monthly')[0]), '2024-02-29')
+        self.assertEqual(days.tolist(), [2])
+
+    def test_flush_drops_period_cut_off_at_the_end(self):
+        rollups.enable(['campaign_performance_weekly'])
+        # Monday 2023-02-27 to Wednesday 2023-03-08, i.e. a run stopped by
+        # the deadline in the middle of the second week.
+        start = datetime.date(2023, 2, 27)
+        rollups.add_rows('m1', 'c1', start, datetime.date(2023, 3, 8),
+                         self._days(start, 10))
+
+        emitted = self._flush('m1')
+
+        self.assertEqual(len(emitted), 1)
+        stream_name, record = emitted[0]
+        self.assertEqual(stream_name, 'campaign_performance_weekly')
+        self.assertEqual(record['campaignId'], 'c1')
+        self.assertEqual(record['periodStart'], '2023-02-27')
+        self.assertEqual(record['periodEnd'], '2023-03-05')
+        self.assertEqual(record['days'], 7)
+        self.assertEqual(record['clicks'], 7)
+        self.assertEqual(record['ctr'], 10.0)
+
+    def test_flush_drops_period_starting_before_coverage(self):
+        rollups.enable(['campaign_performance_weekly'])
+        # Starts on a Wednesday, the first week is only partially fetched.
+        start = datetime.date(2023, 3, 1)
+        rollups.add_rows('m1', 'c1', start, datetime.date(2023, 3, 12),
+                         self._days(start, 12))
+
+        emitted = self._flush('m1')
+
+        self.assertEqual([record['periodStart'] for _, record in emitted],
+                         ['2023-03-06'])
+
+    def test_flush_keeps_current_period_when_synced_up_to_today(self):
+        rollups.enable(['campaign_performance_weekly'])
+        today = datetime.date.today()
+        start = rollups.week_start(today)
+        rollups.add_rows('m1', 'c1', start, today,
+                         self._days(start, (today - start).days + 1))
+
+        emitted = self._flush('m1')
+
+        self.assertEqual([record['periodStart'] for _, record in emitted],
+                         [start.isoformat()])
+
+    def test_flush_windows_extend_coverage(self):
+        rollups.enable(['campaign_performance_weekly'])
+        first, second = datetime.date(2023, 2, 27), datetime.date(2023, 3, 6)
+        rollups.add_rows('m1', 'c1', first, datetime.date(2023, 3, 5),
+                         self._days(first, 7))
+        rollups.add_rows('m1', 'c1', second, datetime.date(2023, 3, 12),
+                         self._days(second, 7))
+
+        emitted = self._flush('m1')
+
+        self.assertEqual([record['periodStart'] for _, record in emitted],
+                         ['2023-02-27', '2023-03-06'])
+
+    def test_flush_marketer_periods_covered_by_every_campaign(self):
+        rollups.enable(['marketer_performance_weekly'])
+        start = datetime.date(2023, 2, 27)
+        rollups.add_rows('m1', 'c1', start, datetime.date(2023, 3, 12),
+                         self._days(start, 14))
+        # c2 was only fetched for the first week
+        rollups.add_rows('m1', 'c2', start, datetime.date(2023, 3, 5),
+                         self._days(start, 7, clicks=2))
+
+        emitted = self._flush('m1')
+
+        self.assertEqual(len(emitted), 1)
+        stream_name, record = emitted[0]
+        self.assertEqual(stream_name, 'marketer_performance_weekly')
+        self.assertEqual(record['marketerId'], 'm1')
+        self.assertEqual(record['periodStart'], '2023-02-27')
+        self.assertEqual(record['clicks'], 7 + 14)
+        self.assertNotIn('campaignId', record)
+
+    def test_flush_skips_marketer_rollups_when_incomplete(self):
+        rollups.enable(['campaign_performance_weekly', 'marketer_performance_weekly'])
+        start = datetime.date(2023, 2, 27)
+        rollups.add_rows('m1', 'c1', start, datetime.date(2023, 3, 5),
+                         self._days(start, 7))
+
+        emitted = self._flush('m1', complete=False)
+
+        self.assertEqual([stream_name for stream_name, _ in emitted],
+                         ['campaign_performance_weekly'])
+
+    def test_flush_accounts_separately(self):
+        rollups.enable(['campaign_performance_weekly'])
+        start = datetime.date(2023, 2, 27)
+        rollups.add_rows('m1', 'c1', start, datetime.date(2023, 3, 5),
+                         self._days(start, 7))
+        rollups.add_rows('m2', 'c2', start, datetime.date(2023, 3, 5),
+                         self._days(start, 7))
+
+        emitted = self._flush('m1')
+
+        self.assertEqual([record['campaignId'] for _, record in emitted], ['c1'])
+        self.assertIn('m2', rollups._BUFFERS)
+
+
+if __name__ == '__main__':
+    unittest.main()